@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+
+class AdmissionError(Exception):
+    """Запрос отклонен из-за превышения лимитов нагрузки, его можно повторить позже."""
+
+
+class RequestTooLarge(AdmissionError):
+    """Запрос не может быть допущен никогда, повторять его бессмысленно."""
+
+
+class TokenBucket(object):
+    """
+    Ведро токенов: пополняется со скоростью rate токенов в секунду
+    до capacity, каждый запрос забирает столько токенов, сколько стоит.
+    """
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.timestamp = clock()
+
+    def consume(self, tokens=1):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        if tokens > self.tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def is_full(self, now):
+        return self.tokens + (now - self.timestamp) * self.rate >= self.capacity
+
+
+class AdmissionControl(object):
+    """
+    Контроль допуска запросов. Нулевое значение лимита отключает его:
+    rate - пополнение ведра аккаунта (единиц стоимости в секунду),
+    burst - емкость ведра аккаунта (по умолчанию равна rate),
+    max_in_flight - максимум одновременно принятых запросов (выполняющихся и ожидающих очереди),
+    max_client_ids - максимум client_ids в одном запросе clients_interests.
+    """
+    def __init__(self, rate=0, burst=0, max_in_flight=0, max_client_ids=0, clock=time.time):
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_in_flight = max_in_flight
+        self.max_client_ids = max_client_ids
+        self.clock = clock
+        self.buckets = {}
+        # полное ведро не отличается от нового, такие ведра удаляются раз в период наполнения,
+        # поэтому хранятся только ведра аккаунтов, обращавшихся за последние два периода
+        self.refill_time = float(self.burst) / self.rate if self.rate else 0
+        self.evicted = clock()
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def check_client_ids(self, count):
+        if self.max_client_ids and count > self.max_client_ids:
+            raise RequestTooLarge('Too many client_ids: {} (limit {})'.format(count, self.max_client_ids))
+
+    def check_rate(self, key, cost=1):
+        if not self.rate:
+            return
+        if cost > self.burst:
+            # ведро никогда не наполнится до такой стоимости
+            raise RequestTooLarge('Request cost {} exceeds burst {}'.format(cost, self.burst))
+        with self.lock:
+            now = self.clock()
+            if now - self.evicted >= self.refill_time:
+                self.evict_full(now)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, self.clock)
+            admitted = bucket.consume(cost)
+        if not admitted:
+            raise AdmissionError('Rate limit exceeded for "{}"'.format(key))
+
+    def evict_full(self, now):
+        self.buckets = dict((key, bucket) for key, bucket in self.buckets.items() if not bucket.is_full(now))
+        self.evicted = now
+
+    def enter(self):
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
@@ -4,14 +4,24 @@
 import json
 import uuid
 import logging
+import time
 import hashlib
 import datetime
+import threading
 from optparse import OptionParser
+from SocketServer import ThreadingMixIn
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 from store import Store
+from store import CompactStore
+from admission import AdmissionControl
+from admission import AdmissionError
+from admission import RequestTooLarge
+from store import CONNECTED
+from store import DeadlineExceeded
 from scoring import get_score
 from scoring import get_interests
+from scoring import get_interests_as_of
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -20,14 +30,22 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
 UNKNOWN = 0
 MALE = 1
@@ -43,6 +61,7 @@ try:
 except NameError:
     STR_TYPE = str
     PYTHON2 = False
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout'
 NOT_EMPTY_GROUP_ATTR = (('phone', 'email'), ('first_name', 'last_name'), ('birthday', 'gender'))
 VALIDATION_ERROR_MESSAGE = False
 
@@ -158,7 +177,7 @@ class DateField(FieldBase):
 
     def validate(self, value):
         result = super(DateField, self).validate(value)
-        if result is True:
+        if result is True and value:
             if self.str_to_date(value) is None:
                 result = False
         return result
@@ -266,8 +285,29 @@ def is_empty_value_in_group_attr(arguments):
     return result
 
 
+def get_deadline(headers, default_timeout):
+    """
+    Момент времени, после которого запрос перестает обрабатываться.
+    Клиент может сократить бюджет времени заголовком X-Request-Timeout (секунды),
+    но не увеличить его сверх default_timeout. Без обоих ограничений - None.
+    """
+    timeout = default_timeout
+    try:
+        client_timeout = float(headers.get(REQUEST_TIMEOUT_HEADER))
+    except (TypeError, ValueError):
+        client_timeout = None
+    if client_timeout is not None and client_timeout > 0:
+        timeout = min(timeout, client_timeout) if timeout else client_timeout
+    return time.time() + timeout if timeout else None
+
+
 def method_handler(request, ctx):
     response = ''
+    # бюджет времени отсчитывается с момента поступления запроса (см. do_POST)
+    if 'deadline' in request:
+        deadline = request['deadline']
+    else:
+        deadline = get_deadline(request['headers'], MainHTTPHandler.request_timeout)
     try:
         method_request = set_attributes(MethodRequest, request['body'])
         if not check_auth(method_request):
@@ -291,39 +331,128 @@ def method_handler(request, ctx):
                     )
                 if method_request().is_admin:
                     response = {'score': 42}
+                cost = 1
             # method: clients_interests
             else:
                 # вычисление кол-ва переданных id клиентов
                 # и сохранение в словаре контекста
                 clients_ids = set(method_request.arguments['client_ids'])
                 ctx['nclients'] = len(clients_ids)
+                # стоимость запроса пропорциональна кол-ву клиентов
+                cost = ctx['nclients']
+                MainHTTPHandler.admission.check_client_ids(cost)
+            MainHTTPHandler.admission.check_rate(method_request.account or method_request.login, cost)
             if not response:
                 # вызов запрашиваемого метода из MainHTTPHandler
-                response = json.dumps(requested_method(MainHTTPHandler, **request['body']['arguments']))
+                response = json.dumps(requested_method(MainHTTPHandler, deadline=deadline, ctx=ctx,
+                                                       **request['body']['arguments']))
             code = OK
     except ValidationError as err:
         if VALIDATION_ERROR_MESSAGE:
             logging.error('{} {}'.format(ctx["request_id"], err.message))
         response, code = err.message, INVALID_REQUEST
+    except RequestTooLarge as err:
+        logging.warning('{} {}'.format(ctx["request_id"], err.message))
+        response, code = err.message, REQUEST_ENTITY_TOO_LARGE
+    except AdmissionError as err:
+        logging.warning('{} {}'.format(ctx["request_id"], err.message))
+        response, code = err.message, TOO_MANY_REQUESTS
+    except DeadlineExceeded as err:
+        logging.warning('{} {}'.format(ctx["request_id"], err.message))
+        response, code = err.message, GATEWAY_TIMEOUT
     return response, code
 
 
+def storage_state(store):
+    return store.state if store is not None else 'not configured'
+
+
+def health_handler(request, ctx):
+    # liveness: процесс жив и обслуживает запросы, состояние хранилища только сообщается
+    return {'status': 'alive', 'storage': storage_state(request['store'])}, OK
+
+
+def ready_handler(request, ctx):
+    # readiness: готовы принимать трафик только при установленном соединении с хранилищем
+    state = storage_state(request['store'])
+    if state == CONNECTED:
+        return {'status': 'ready', 'storage': state}, OK
+    return 'Storage is {}'.format(state), SERVICE_UNAVAILABLE
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
+    get_router = {
+        "health": health_handler,
+        "ready": ready_handler,
+    }
+    store = None
+    admission = AdmissionControl()
+    # бюджет времени на обработку запроса в секундах, 0 - без ограничения
+    request_timeout = 0
+    # значения полей запросов хранятся в классах (DeclarativeMeta), поэтому методы
+    # выполняются по одному, а GET запросы (/health, /ready) обслуживаются без ожидания
+    method_lock = threading.Lock()
+
+    @classmethod
+    def set_storage(cls, storage, *args, **kwargs):
+        cls.store = storage(*args, **kwargs)
 
     @classmethod
-    def set_storage(cls, storage, *args):
-        cls.store = storage(*args)
+    def set_admission(cls, *args):
+        cls.admission = AdmissionControl(*args)
 
     @classmethod
     def connect_storage(cls):
-        if hasattr(cls, 'store'):
+        if cls.store is not None:
             cls.store.connect()
 
+    @classmethod
+    def connect_storage_background(cls):
+        """
+        Подключение к хранилищу в фоновом потоке,
+        чтобы сервер начал принимать запросы не дожидаясь redis.
+        """
+        def target():
+            try:
+                cls.connect_storage()
+            except Exception as e:
+                logging.error('Storage connection failed: {}'.format(e))
+            else:
+                logging.info('Storage connected')
+        thread = threading.Thread(target=target, name='storage-connect')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @classmethod
+    def monitor_storage_background(cls, interval, stop=None):
+        """
+        Периодическая проверка доступности хранилища в фоновом потоке,
+        по ее результату /ready отвечает не обращаясь к redis.
+        Проверки прекращаются, когда установлено событие stop.
+        """
+        stop = stop or threading.Event()
+
+        def target():
+            while not stop.wait(interval):
+                try:
+                    cls.store.check()
+                except Exception as e:
+                    logging.exception('Storage check failed: {}'.format(e))
+        thread = threading.Thread(target=target, name='storage-monitor')
+        thread.daemon = True
+        thread.start()
+        return thread
+
     @staticmethod
-    def online_score(cls, **kwargs):
+    def online_score(cls, deadline=None, ctx=None, **kwargs):
         request = set_attributes(OnlineScoreRequest, kwargs)
         birthday = DateField.str_to_date(request.birthday)
         result = dict()
@@ -336,23 +465,79 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
 
         result['score'] = get_score(cls.store, request.phone, request.email,
                                     birthday, request.gender,
-                                    first_name, last_name)
+                                    first_name, last_name, deadline)
         return result
 
     @staticmethod
-    def clients_interests(cls, **kwargs):
+    def clients_interests(cls, deadline=None, ctx=None, **kwargs):
         request = set_attributes(ClientsInterestsRequest, kwargs)
-        result = dict()
+        date = DateField.str_to_date(request.date)
+        # повторяющиеся id запрашиваются один раз, как и учитываются в стоимости запроса
+        client_ids, seen = [], set()
         for cid in request.client_ids:
-            result[cid] = get_interests(cls.store, cid)
+            if cid not in seen:
+                seen.add(cid)
+                client_ids.append(cid)
+        if date is None:
+            batches = ({cid: get_interests(cls.store, cid, deadline)} for cid in client_ids)
+        else:
+            # интересы на указанную дату из истории
+            batches = get_interests_as_of(cls.store, client_ids, date, deadline)
+        result = dict()
+        try:
+            for batch in batches:
+                result.update(batch)
+        except DeadlineExceeded:
+            if not result:
+                raise
+            # частичный ответ: клиенты, для которых не хватило времени, перечисляются в missing
+            missing = sorted(set(client_ids) - set(result))
+            logging.warning('Request deadline exceeded, returning {} of {} clients'.format(
+                len(result), len(result) + len(missing)))
+            if ctx is not None:
+                ctx['partial'] = True
+                ctx['missing'] = missing
+        # клиенты без снимка интересов на указанную дату: пустой список и перечисление в no_history
+        no_history = sorted(cid for cid, interests in result.items() if interests is None)
+        for cid in no_history:
+            result[cid] = []
+        if no_history and ctx is not None:
+            ctx['no_history'] = no_history
         return result
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def write_response(self, response, code, context):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        if code not in ERRORS:
+            r = {"response": response, "code": code}
+            if context.get('partial'):
+                r.update(partial=True, missing=context['missing'])
+            if context.get('no_history'):
+                r['no_history'] = context['no_history']
+        else:
+            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+        context.update(r)
+        logging.info(context)
+        self.wfile.write(json.dumps(r))
+
+    def do_GET(self):
+        response, code = {}, OK
+        context = {"request_id": self.get_request_id(self.headers)}
+        path = self.path.strip("/")
+        if path in self.get_router:
+            response, code = self.get_router[path]({"store": self.store, "headers": self.headers}, context)
+        else:
+            code = NOT_FOUND
+        self.write_response(response, code, context)
+
     def do_POST(self):
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
+        deadline = get_deadline(self.headers, self.request_timeout)
         request = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
@@ -365,24 +550,28 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             path = self.path.strip("/")
             logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context)
-                except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
+                # отклоняем сразу, если принято max_in_flight запросов (выполняющийся
+                # и ожидающие method_lock), а не ставим в очередь
+                if self.admission.enter():
+                    try:
+                        with self.method_lock:
+                            # время ожидания очереди входит в бюджет времени запроса
+                            if deadline is not None and time.time() >= deadline:
+                                response, code = 'Request deadline exceeded while queued', GATEWAY_TIMEOUT
+                            else:
+                                response, code = self.router[path](
+                                    {"body": request, "headers": self.headers, "deadline": deadline}, context)
+                    except Exception as e:
+                        logging.exception("Unexpected error: %s" % e)
+                        code = INTERNAL_ERROR
+                    finally:
+                        self.admission.leave()
+                else:
+                    code = TOO_MANY_REQUESTS
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
+        self.write_response(response, code, context)
         return
 
 
@@ -397,14 +586,28 @@ if __name__ == "__main__":
     op.add_option("-c", "--storage_connect_timeout", action="store", type=int, default='20')
     op.add_option("-d", "--storage_connect_delay", action="store", type=int, default='1')
     op.add_option("-a", "--storage_connect_attemps", action="store", type=int, default='0')
+    op.add_option("-i", "--storage_check_interval", action="store", type=float, default='5')
+    op.add_option("-r", "--rate_limit", action="store", type=int, default='0')
+    op.add_option("-b", "--rate_burst", action="store", type=int, default='0')
+    op.add_option("-f", "--max_in_flight", action="store", type=int, default='0')
+    op.add_option("-m", "--max_client_ids", action="store", type=int, default='0')
+    op.add_option("-T", "--request_timeout", action="store", type=float, default='10')
+    op.add_option("-C", "--compact_cache", action="store_true", default=False)
+    op.add_option("-B", "--compact_cache_bucket_bytes", action="store", type=int, default='2')
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
     storage_opts = (opts.storage_host, opts.storage_port, opts.storage_timeout,
                     opts.storage_connect_timeout, opts.storage_connect_delay, opts.storage_connect_attemps)
-    MainHTTPHandler.set_storage(Store, *storage_opts)
-    MainHTTPHandler.connect_storage()
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    if opts.compact_cache:
+        MainHTTPHandler.set_storage(CompactStore, *storage_opts, bucket_bytes=opts.compact_cache_bucket_bytes)
+    else:
+        MainHTTPHandler.set_storage(Store, *storage_opts)
+    MainHTTPHandler.request_timeout = opts.request_timeout
+    MainHTTPHandler.set_admission(opts.rate_limit, opts.rate_burst, opts.max_in_flight, opts.max_client_ids)
+    server = ThreadingHTTPServer(("localhost", opts.port), MainHTTPHandler)
+    MainHTTPHandler.connect_storage_background()
+    MainHTTPHandler.monitor_storage_background(opts.storage_check_interval)
     logging.info("Starting server at %s" % opts.port)
     try:
         server.serve_forever()
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import datetime
+from optparse import OptionParser
+
+from store import Store
+from scoring import backfill_interests_history
+
+
+if __name__ == "__main__":
+    # снимок текущих интересов (i:<id>) в истории (ih:<id>) на дату --date (DD.MM.YYYY, по умолчанию сегодня)
+    # для клиентов, у которых истории еще нет
+    op = OptionParser()
+    op.add_option("-s", "--storage_host", action="store", default='localhost')
+    op.add_option("-P", "--storage_port", action="store", type=int, default='6379')
+    op.add_option("-d", "--date", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    date = datetime.datetime.strptime(opts.date, '%d.%m.%Y').date() if opts.date else None
+    store = Store(opts.storage_host, opts.storage_port, attempts=1)
+    store.connect()
+    logging.info('Interests history backfilled for {} clients'.format(backfill_interests_history(store, date)))
@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
+import datetime
 
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None, deadline=None):
     key_parts = [
         first_name or "",
         last_name or "",
@@ -13,7 +14,7 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     key = "uid:" + hashlib.md5(''.join(key_parts)).hexdigest()
     # try get from cache,
     # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
+    score = store.cache_get(key, deadline=deadline) or 0
     if score:
         return score
     if phone:
@@ -25,10 +26,45 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     if first_name and last_name:
         score += 0.5
     # cache for 60 minutes
-    store.cache_set(key, score,  60 * 60)
+    store.cache_set(key, score,  60 * 60, deadline=deadline)
     return score
 
 
-def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
+def get_interests(store, cid, deadline=None):
+    r = store.get("i:%s" % cid, deadline=deadline)
     return r if r else []
+
+
+def interests_version(date):
+    return int(date.strftime("%Y%m%d"))
+
+
+def set_interests_as_of(store, cid, date, interests):
+    return store.set_as_of("ih:%s" % cid, interests_version(date), interests)
+
+
+def set_interests(store, cid, interests, date=None):
+    # текущие интересы записываются вместе со снимком в истории на дату date (по умолчанию сегодня)
+    date = date or datetime.date.today()
+    return store.set("i:%s" % cid, interests, "ih:%s" % cid, interests_version(date))
+
+
+def backfill_interests_history(store, date=None):
+    # снимок текущих интересов на дату date для клиентов, у которых еще нет истории
+    version = interests_version(date or datetime.date.today())
+    count = 0
+    for key in store.scan("i:*"):
+        cid = key.split(":", 1)[1]
+        if store.set_as_of("ih:%s" % cid, version, store.get(key), replace=False):
+            count += 1
+    return count
+
+
+def get_interests_as_of(store, cids, date, deadline=None, batch_size=100):
+    # генератор: на каждую пачку клиентов один pipelined запрос к хранилищу,
+    # для клиентов без снимка на дату date - None
+    version = interests_version(date)
+    for i in range(0, len(cids), batch_size):
+        batch = cids[i:i + batch_size]
+        r = store.get_as_of(["ih:%s" % cid for cid in batch], version, deadline=deadline)
+        yield dict(zip(batch, r))
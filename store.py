@@ -3,16 +3,81 @@
 
 import json
 import time
+import struct
+import hashlib
 import logging
+import binascii
+import threading
+from contextlib import contextmanager
 
 import redis
 
 
+class DeadlineExceeded(redis.TimeoutError):
+    """Бюджет времени запроса исчерпан, дальнейшие обращения к хранилищу не выполняются"""
+
+
+def remaining(deadline):
+    """Оставшееся до deadline время в секундах, None - без ограничения"""
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def check_deadline(deadline):
+    if deadline is not None and remaining(deadline) <= 0:
+        raise DeadlineExceeded('Request deadline exceeded')
+
+
+class DeadlineConnection(redis.Connection):
+    """
+    Соединение redis, в котором таймауты подключения и чтения/записи сокета
+    не превышают оставшийся бюджет времени запроса текущего потока (см. deadline_scope).
+    """
+    local = threading.local()
+
+    def limit(self, timeout):
+        left = remaining(getattr(self.local, 'deadline', None))
+        if left is None:
+            return timeout
+        # нулевой таймаут перевел бы сокет в неблокирующий режим
+        left = max(left, 0.001)
+        return left if timeout is None else min(timeout, left)
+
+    def _connect(self):
+        connect_timeout, timeout = self.socket_connect_timeout, self.socket_timeout
+        self.socket_connect_timeout, self.socket_timeout = self.limit(connect_timeout), self.limit(timeout)
+        try:
+            return super(DeadlineConnection, self)._connect()
+        finally:
+            self.socket_connect_timeout, self.socket_timeout = connect_timeout, timeout
+
+    def send_packed_command(self, command):
+        if self._sock:
+            self._sock.settimeout(self.limit(self.socket_timeout))
+        return super(DeadlineConnection, self).send_packed_command(command)
+
+    def read_response(self):
+        if self._sock:
+            self._sock.settimeout(self.limit(self.socket_timeout))
+        return super(DeadlineConnection, self).read_response()
+
+
+@contextmanager
+def deadline_scope(deadline):
+    previous = getattr(DeadlineConnection.local, 'deadline', None)
+    DeadlineConnection.local.deadline = deadline
+    try:
+        yield
+    finally:
+        DeadlineConnection.local.deadline = previous
+
+
 def exept_handler(method):
-    def wrapper(self, *args):
+    def wrapper(self, *args, **kwargs):
         response = None
         try:
-            response = method(self, *args)
+            response = method(self, *args, **kwargs)
         except (redis.ConnectionError, redis.TimeoutError) as err:
             logging.info('<{}> method with args {} not executed ({})'.format(method.__name__, args, err.message))
         except ValueError as err:
@@ -21,9 +86,15 @@ def exept_handler(method):
     return wrapper
 
 
+DISCONNECTED = 'disconnected'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+
+
 class Store(object):
     """Класс предоставляет интерфейс к хранилищу redis"""
-    def __init__(self, host='localhost', port=6379, timeout=3, connect_timeout=20, connect_delay=1, attempts=0):
+    def __init__(self, host='localhost', port=6379, timeout=3, connect_timeout=20, connect_delay=1, attempts=0,
+                 check_timeout=1):
         self.host = host
         self.port = port
         self.timeout = timeout
@@ -31,41 +102,110 @@ class Store(object):
         self.connect_delay = connect_delay
         self.attempts = attempts
         self.i = 0
-        self.redis = redis.Redis(host=self.host, port=self.port, db=0,
-                                 socket_timeout=self.timeout,
-                                 socket_connect_timeout=self.connect_timeout)
-
-    def connect(self):
-        self.i = 1
-        loop = True
-        while loop:
-            try:
-                connection = self.redis.connection_pool.get_connection('')
-                connection.connect()
-                loop = False
-            except (redis.ConnectionError, redis.TimeoutError):
-                time.sleep(self.connect_delay)
-                if self.attempts and self.i == self.attempts:
-                    raise
-                else:
-                    self.i += 1
-            finally:
-                # возвращаем коннекшн в пул соединений
-                self.redis.connection_pool.release(connection)
+        self.state = DISCONNECTED
+        # кол-во выполняющихся в данный момент подключений (фоновое и из запросов)
+        self.connecting = 0
+        self.lock = threading.Lock()
+        self.redis = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=DeadlineConnection, host=self.host, port=self.port, db=0,
+            socket_timeout=self.timeout, socket_connect_timeout=self.connect_timeout))
+        # отдельный клиент с коротким таймаутом для проверки доступности хранилища
+        self.check_redis = redis.Redis(host=self.host, port=self.port, db=0,
+                                       socket_timeout=check_timeout,
+                                       socket_connect_timeout=check_timeout)
+
+    @property
+    def is_connected(self):
+        return self.state == CONNECTED
+
+    def begin_connect(self):
+        with self.lock:
+            self.connecting += 1
+            self.state = CONNECTING
+
+    def end_connect(self, connected):
+        with self.lock:
+            self.connecting -= 1
+            if connected:
+                self.state = CONNECTED
+            elif not self.connecting:
+                # неудача одного подключения не меняет состояние, пока выполняется другое
+                self.state = DISCONNECTED
+
+    def connect(self, deadline=None, attempts=None):
+        """
+        Подключение к хранилищу, attempts (по умолчанию self.attempts, 0 - без ограничения)
+        попыток с паузой connect_delay между ними, не дольше deadline.
+        """
+        attempts = self.attempts if attempts is None else attempts
+        self.begin_connect()
+        connected = False
+        try:
+            with deadline_scope(deadline):
+                self.i = 1
+                loop = True
+                while loop:
+                    check_deadline(deadline)
+                    try:
+                        connection = self.redis.connection_pool.get_connection('')
+                        connection.connect()
+                        loop = False
+                    except (redis.ConnectionError, redis.TimeoutError):
+                        if attempts and self.i == attempts:
+                            raise
+                        delay = self.connect_delay
+                        if deadline is not None:
+                            delay = max(0, min(delay, remaining(deadline)))
+                        time.sleep(delay)
+                        self.i += 1
+                    finally:
+                        # возвращаем коннекшн в пул соединений
+                        self.redis.connection_pool.release(connection)
+            connected = True
+        finally:
+            self.end_connect(connected)
+
+    def check(self):
+        """Проверка доступности хранилища командой PING с коротким таймаутом, обновляет state"""
+        try:
+            available = self.check_redis.ping()
+        except redis.RedisError as err:
+            # в том числе ошибки ответа (например, NOAUTH): хранилище не готово к работе
+            logging.info('Storage check failed ({})'.format(err))
+            available = False
+        with self.lock:
+            if available:
+                self.state = CONNECTED
+            elif not self.connecting:
+                self.state = DISCONNECTED
+        return available
 
     @staticmethod
     def reconnect(method):
-        def wrapper(self, *args):
-            try:
-                return method(self, *args)
-            except (redis.ConnectionError, redis.TimeoutError):
-                self.connect()
-                return method(self, *args)
+        def wrapper(self, *args, **kwargs):
+            deadline = kwargs.get('deadline')
+            check_deadline(deadline)
+            with deadline_scope(deadline):
+                try:
+                    return method(self, *args, **kwargs)
+                except DeadlineExceeded:
+                    raise
+                except (redis.ConnectionError, redis.TimeoutError):
+                    # повторное подключение в пределах бюджета времени запроса, без бюджета -
+                    # одна попытка, чтобы запрос не ждал redis бесконечно; connect обновляет state
+                    self.connect(deadline, attempts=1 if deadline is None else None)
+                    check_deadline(deadline)
+                    try:
+                        return method(self, *args, **kwargs)
+                    except (redis.ConnectionError, redis.TimeoutError):
+                        # таймаут сокета, ограниченный бюджетом, означает его исчерпание
+                        check_deadline(deadline)
+                        raise
         return wrapper
 
     @exept_handler
     @reconnect.__func__
-    def cache_get(self, key):
+    def cache_get(self, key, deadline=None):
         response = self.redis.get(key)
         if response is not None:
             response = json.loads(response)
@@ -73,10 +213,140 @@ class Store(object):
 
     @exept_handler
     @reconnect.__func__
-    def cache_set(self, key, value, expire):
+    def cache_set(self, key, value, expire, deadline=None):
         return self.redis.set(key, value, ex=expire)
 
     @reconnect.__func__
-    def get(self, key):
+    def get(self, key, deadline=None):
         response = self.redis.lrange(key, 0, -1)
         return response
+
+    @reconnect.__func__
+    def set(self, key, values, version_key=None, version=None, deadline=None):
+        """
+        Запись списка values в key и, если задан version_key, его версии version
+        в version_key (см. set_as_of) в одной транзакции.
+        """
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        if values:
+            pipe.rpush(key, *values)
+        if version_key is not None:
+            self.add_version(pipe, version_key, version, values)
+        return pipe.execute()
+
+    def scan(self, pattern):
+        """Итератор по ключам хранилища, соответствующим pattern"""
+        return self.redis.scan_iter(match=pattern, count=1000)
+
+    @reconnect.__func__
+    def get_as_of(self, keys, version, deadline=None):
+        """
+        Версионированные значения ключей (sorted set, score - версия) на момент version:
+        для каждого ключа последнее значение с версией не больше version или None.
+        Все ключи запрашиваются одним pipeline.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrevrangebyscore(key, version, '-inf', start=0, num=1)
+        return [json.loads(r[0].split(':', 1)[1]) if r else None for r in pipe.execute()]
+
+    @staticmethod
+    def add_version(pipe, key, version, value):
+        # версия в члене sorted set делает одинаковые значения разных версий уникальными
+        member = '{}:{}'.format(version, json.dumps(value))
+        pipe.zremrangebyscore(key, version, version)
+        pipe.zadd(key, member, version)
+
+    @reconnect.__func__
+    def set_as_of(self, key, version, value, replace=True, deadline=None):
+        """Запись версии значения, при replace=False - только если версий у ключа еще нет"""
+        if not replace and self.redis.exists(key):
+            return False
+        pipe = self.redis.pipeline()
+        self.add_version(pipe, key, version, value)
+        return bool(pipe.execute()[-1])
+
+
+class CompactStore(Store):
+    """
+    Хранилище с компактным кэшем: вместо отдельного строкового ключа с TTL
+    на каждое значение, значения группируются в hash-и redis.
+    Ключ вида "<префикс>:<hex-дайджест>" раскладывается на бакет
+    "<префикс>:<номер окна>:<первые bucket_bytes байт дайджеста в hex>" и бинарное поле
+    из оставшихся байт дайджеста. Значение хранится как время истечения (uint32)
+    и число (double). Номер окна - время записи, деленное на window секунд,
+    срок хранения значения не больше window. Все записи бакета задают ему одно и то же
+    время удаления (EXPIREAT) - конец следующего окна, поэтому бакет удаляется целиком
+    не позже, чем через window после истечения последнего его значения,
+    даже если значения из него никогда не читаются.
+    Выигрыш в памяти есть, пока hash-и остаются в компактной кодировке redis
+    (не больше hash-max-ziplist-entries, по умолчанию 128, полей) и при этом
+    не слишком разрежены (бакет из одного поля дороже отдельного ключа).
+    В окне 256 ** bucket_bytes бакетов, поэтому bucket_bytes выбирается по кол-ву
+    ключей N, записываемых за window: 1 - N до ~32 тыс., 2 - до ~8 млн., 3 - до ~2 млрд.
+    """
+    value_format = struct.Struct('<Id')
+
+    def __init__(self, host='localhost', port=6379, timeout=3, connect_timeout=20, connect_delay=1, attempts=0,
+                 check_timeout=1, bucket_bytes=2, window=60 * 60):
+        super(CompactStore, self).__init__(host, port, timeout, connect_timeout, connect_delay, attempts,
+                                           check_timeout)
+        self.bucket_bytes = bucket_bytes
+        self.window = window
+
+    def current_window(self):
+        return int(time.time() // self.window)
+
+    def cache_location(self, key, window):
+        prefix, _, name = key.rpartition(':')
+        try:
+            digest = binascii.unhexlify(name)
+        except (TypeError, binascii.Error):
+            digest = hashlib.md5(name).digest()
+        if len(digest) <= self.bucket_bytes:
+            digest = hashlib.md5(digest).digest()
+        bucket = '{}:{}:{}'.format(prefix, window, binascii.hexlify(digest[:self.bucket_bytes]))
+        return bucket, digest[self.bucket_bytes:]
+
+    @classmethod
+    def pack_value(cls, value, expire):
+        return cls.value_format.pack(int(time.time()) + expire, float(value))
+
+    @classmethod
+    def unpack_value(cls, data):
+        """Число из значения поля или None, если срок хранения истек или значение повреждено"""
+        try:
+            expires_at, value = cls.value_format.unpack(data)
+        except struct.error as err:
+            logging.error('The cache value can not be unpacked ({})'.format(err))
+            return None
+        if expires_at <= time.time():
+            return None
+        return value
+
+    @exept_handler
+    @Store.reconnect
+    def cache_get(self, key, deadline=None):
+        # значение могло быть записано в текущем или предыдущем окне, более новое - первым
+        window = self.current_window()
+        pipe = self.redis.pipeline(transaction=False)
+        for w in (window, window - 1):
+            pipe.hget(*self.cache_location(key, w))
+        for response in pipe.execute():
+            if response is not None:
+                response = self.unpack_value(response)
+                if response is not None:
+                    return response
+        return None
+
+    @exept_handler
+    @Store.reconnect
+    def cache_set(self, key, value, expire, deadline=None):
+        window = self.current_window()
+        bucket, field = self.cache_location(key, window)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(bucket, field, self.pack_value(value, min(expire, self.window)))
+        pipe.expireat(bucket, (window + 2) * self.window)
+        pipe.execute()
+        return True
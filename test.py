@@ -1,14 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
+import time
 import socket
+import hashlib
+import urllib2
 import unittest
+import threading
 
 import redis
 
 import api
 import scoring
 from store import Store
+from store import CompactStore
+from store import DeadlineExceeded
+from admission import TokenBucket
+from admission import AdmissionControl
+from admission import AdmissionError
+from admission import RequestTooLarge
 
 
 def cases(test_cases):
@@ -125,6 +136,330 @@ class TestSuite(unittest.TestCase):
         for attr, value in kwargs['values'].items():
             self.assertEqual(filled_obj.__dict__[attr].__dict__['value'], value)
 
+    @cases([None, ''])
+    def test_empty_optional_date_attribute(self, value):
+        attr = api.DateField(required=False, nullable=True)
+        self.assertTrue(attr.validate(value))
+
+    def test_health_on_disconnected_store(self):
+        store = Store(port=9999, connect_timeout=1, attempts=1)
+        response, code = api.health_handler({"store": store, "headers": self.headers}, self.context)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response['storage'], 'disconnected')
+
+    @cases(['disconnected', 'connecting'])
+    def test_ready_on_not_connected_store(self, state):
+        store = Store(port=9999, connect_timeout=1, attempts=1)
+        store.state = state
+        _, code = api.ready_handler({"store": store, "headers": self.headers}, self.context)
+        self.assertEqual(api.SERVICE_UNAVAILABLE, code)
+
+    def test_connect_storage_background(self):
+        api.MainHTTPHandler.set_storage(Store, 'localhost', 9999, 1, 1, 0, 1)
+        try:
+            thread = api.MainHTTPHandler.connect_storage_background()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(api.MainHTTPHandler.store.is_connected)
+        finally:
+            api.MainHTTPHandler.store = None
+
+    def test_failed_connect_keeps_state_while_other_connecting(self):
+        store = Store(port=9999, connect_timeout=1, attempts=0)
+        # другое подключение (например, фоновое) еще выполняется
+        store.begin_connect()
+        self.assertRaises(DeadlineExceeded, store.connect, time.time() - 1)
+        self.assertEqual(store.state, 'connecting')
+        store.end_connect(False)
+        self.assertEqual(store.state, 'disconnected')
+
+    def test_check_on_disconnected_store(self):
+        store = Store(port=9999, connect_timeout=1, attempts=1)
+        store.state = 'connected'
+        self.assertFalse(store.check())
+        self.assertEqual(store.state, 'disconnected')
+
+    def test_monitor_survives_check_errors(self):
+        class FailingStore(object):
+            calls = 0
+
+            def check(self):
+                self.calls += 1
+                raise RuntimeError('check failed')
+
+        api.MainHTTPHandler.store = FailingStore()
+        stop = threading.Event()
+        try:
+            thread = api.MainHTTPHandler.monitor_storage_background(0.01, stop)
+            time.sleep(0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertGreater(api.MainHTTPHandler.store.calls, 1)
+        finally:
+            stop.set()
+            thread.join(1)
+            api.MainHTTPHandler.store = None
+
+    def test_probes_not_blocked_by_method(self):
+        server = api.ThreadingHTTPServer(('localhost', 0), api.MainHTTPHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        # выполняющийся метод (например, ожидающий redis) удерживает блокировку
+        api.MainHTTPHandler.method_lock.acquire()
+        try:
+            response = urllib2.urlopen('http://localhost:{}/health'.format(server.server_address[1]), timeout=2)
+            self.assertEqual(response.getcode(), api.OK)
+        finally:
+            api.MainHTTPHandler.method_lock.release()
+            server.shutdown()
+            server.server_close()
+
+
+class DeadlineTest(unittest.TestCase):
+    class PartialStore(object):
+        """Хранилище, у которого бюджет времени заканчивается после первого обращения"""
+        def __init__(self):
+            self.calls = 0
+
+        def get(self, key, deadline=None):
+            self.calls += 1
+            if self.calls > 1:
+                raise DeadlineExceeded('Request deadline exceeded')
+            return ['books']
+
+    def tearDown(self):
+        api.MainHTTPHandler.store = None
+
+    @cases([({}, 0, None),
+            ({'X-Request-Timeout': 'abc'}, 0, None),
+            ({'X-Request-Timeout': '-1'}, 0, None)])
+    def test_no_deadline(self, args):
+        headers, default_timeout, expected = args
+        self.assertEqual(api.get_deadline(headers, default_timeout), expected)
+
+    @cases([({}, 5, 5),
+            ({'X-Request-Timeout': '2'}, 5, 2),
+            ({'X-Request-Timeout': '20'}, 5, 5),
+            ({'X-Request-Timeout': '0.5'}, 0, 0.5)])
+    def test_deadline(self, args):
+        headers, default_timeout, timeout = args
+        deadline = api.get_deadline(headers, default_timeout)
+        self.assertAlmostEqual(deadline - time.time(), timeout, delta=0.1)
+
+    def test_expired_deadline_skips_store(self):
+        store = Store(port=9999, connect_timeout=1, attempts=0)
+        self.assertRaises(DeadlineExceeded, store.get, 'i:1', deadline=time.time() - 1)
+        self.assertIsNone(store.cache_get('uid:1', deadline=time.time() - 1))
+
+    def test_expired_deadline_reconnect(self):
+        store = Store(port=9999, connect_timeout=1, connect_delay=1, attempts=0)
+        start = time.time()
+        self.assertRaises(DeadlineExceeded, store.get, 'i:1', deadline=start + 0.5)
+        self.assertLess(time.time() - start, 2)
+
+    def test_socket_timeout_limited_by_deadline(self):
+        # сервер принимает соединения, но никогда не отвечает
+        blackhole = socket.socket()
+        blackhole.bind(('localhost', 0))
+        blackhole.listen(5)
+        try:
+            store = Store(port=blackhole.getsockname()[1], timeout=3, connect_timeout=3, connect_delay=1)
+            start = time.time()
+            self.assertRaises(DeadlineExceeded, store.get, 'i:1', deadline=start + 0.5)
+            self.assertLess(time.time() - start, 1)
+        finally:
+            blackhole.close()
+
+    def test_reconnect_without_deadline_is_bounded(self):
+        # без бюджета времени и с бесконечными попытками подключения
+        store = Store(port=9999, connect_timeout=1, connect_delay=1, attempts=0)
+        start = time.time()
+        self.assertRaises(redis.ConnectionError, store.get, 'i:1')
+        self.assertLess(time.time() - start, 1)
+
+    def test_clients_interests_partial(self):
+        api.MainHTTPHandler.store = self.PartialStore()
+        ctx = {}
+        result = api.MainHTTPHandler.clients_interests(api.MainHTTPHandler, deadline=time.time() + 1, ctx=ctx,
+                                                       client_ids=[1, 2, 3])
+        self.assertEqual(result, {1: ['books']})
+        self.assertEqual(ctx, {'partial': True, 'missing': [2, 3]})
+
+    def test_deadline_includes_queue_time(self):
+        api.MainHTTPHandler.store = self.PartialStore()
+        server = api.ThreadingHTTPServer(('localhost', 0), api.MainHTTPHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2, 3]}}
+        request['token'] = hashlib.sha512(request['account'] + request['login'] + api.SALT).hexdigest()
+        http_request = urllib2.Request('http://localhost:{}/method/'.format(server.server_address[1]),
+                                       json.dumps(request), {'X-Request-Timeout': '0.2'})
+        # выполняющийся метод удерживает блокировку дольше бюджета времени запроса
+        api.MainHTTPHandler.method_lock.acquire()
+        release = threading.Timer(0.5, api.MainHTTPHandler.method_lock.release)
+        release.start()
+        try:
+            urllib2.urlopen(http_request, timeout=5)
+        except urllib2.HTTPError as err:
+            response = json.load(err)
+        finally:
+            release.join()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(response['code'], api.GATEWAY_TIMEOUT)
+        self.assertEqual(api.MainHTTPHandler.store.calls, 0)
+
+    def test_partial_response_on_server(self):
+        api.MainHTTPHandler.store = self.PartialStore()
+        server = api.ThreadingHTTPServer(('localhost', 0), api.MainHTTPHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2, 3]}}
+        request['token'] = hashlib.sha512(request['account'] + request['login'] + api.SALT).hexdigest()
+        try:
+            response = json.load(urllib2.urlopen('http://localhost:{}/method/'.format(server.server_address[1]),
+                                                 json.dumps(request), timeout=5))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(response['code'], api.OK)
+        self.assertTrue(response['partial'])
+        self.assertEqual(response['missing'], [2, 3])
+
+    def test_get_score_on_expired_deadline(self):
+        store = Store(port=9999, connect_timeout=1, attempts=0)
+        birthday = api.DateField.str_to_date('01.01.1990')
+        score = scoring.get_score(store, '79175002040', '', birthday, 1, 'a', 'b', deadline=time.time() - 1)
+        self.assertAlmostEqual(score, 3.5, delta=0.1)
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.context = {'request_id': 0}
+        self.headers = {}
+        self.now = 0.0
+
+    def tearDown(self):
+        api.MainHTTPHandler.admission = AdmissionControl()
+
+    def clock(self):
+        return self.now
+
+    def get_response(self, request):
+        return api.method_handler({"body": request, "headers": self.headers}, self.context)
+
+    @staticmethod
+    def clients_interests_request(client_ids):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": client_ids}}
+        request['token'] = hashlib.sha512(request['account'] + request['login'] + api.SALT).hexdigest()
+        return request
+
+    def test_token_bucket_refill(self):
+        bucket = TokenBucket(rate=2, capacity=4, clock=self.clock)
+        self.assertTrue(bucket.consume(4))
+        self.assertFalse(bucket.consume(1))
+        self.now += 1
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume(1))
+
+    def test_in_flight_limit_on_server(self):
+        api.MainHTTPHandler.admission = AdmissionControl(max_in_flight=1)
+        server = api.ThreadingHTTPServer(('localhost', 0), api.MainHTTPHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://localhost:{}/method/'.format(server.server_address[1])
+        codes = []
+
+        def post():
+            try:
+                response = urllib2.urlopen(url, json.dumps({'method': 'online_score'}), timeout=5)
+            except urllib2.HTTPError as err:
+                response = err
+            codes.append(json.load(response)['code'])
+
+        # первый запрос принят и ждет выполняющийся метод, второй отклоняется сразу
+        api.MainHTTPHandler.method_lock.acquire()
+        try:
+            waiting = threading.Thread(target=post)
+            waiting.start()
+            deadline = time.time() + 5
+            while not api.MainHTTPHandler.admission.in_flight and time.time() < deadline:
+                time.sleep(0.01)
+            post()
+            self.assertEqual(codes, [api.TOO_MANY_REQUESTS])
+        finally:
+            api.MainHTTPHandler.method_lock.release()
+            waiting.join(5)
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(codes, [api.TOO_MANY_REQUESTS, api.INVALID_REQUEST])
+
+    def test_full_buckets_evicted(self):
+        admission = AdmissionControl(rate=2, burst=4, clock=self.clock)
+        for login in range(100):
+            admission.check_rate(login)
+        self.now += 1.5
+        admission.check_rate('active', 4)
+        self.assertEqual(len(admission.buckets), 101)
+        # за период наполнения (burst / rate) ведра неактивных аккаунтов наполнились
+        self.now += 0.5
+        admission.check_rate('new')
+        self.assertEqual(sorted(admission.buckets), ['active', 'new'])
+        self.assertRaises(AdmissionError, admission.check_rate, 'active', 2)
+
+    def test_in_flight_limit(self):
+        admission = AdmissionControl(max_in_flight=1)
+        self.assertTrue(admission.enter())
+        self.assertFalse(admission.enter())
+        admission.leave()
+        self.assertTrue(admission.enter())
+
+    def test_too_many_client_ids(self):
+        api.MainHTTPHandler.admission = AdmissionControl(max_client_ids=2)
+        _, code = self.get_response(self.clients_interests_request([1, 2, 3]))
+        self.assertEqual(api.REQUEST_ENTITY_TOO_LARGE, code)
+
+    def test_rate_limit_weighted_by_cost(self):
+        admission = AdmissionControl(rate=1, burst=3, clock=self.clock)
+        admission.check_rate('horns&hoofs', 2)
+        with self.assertRaises(AdmissionError) as err:
+            admission.check_rate('horns&hoofs', 2)
+        self.assertNotIsInstance(err.exception, RequestTooLarge)
+        self.now += 1
+        admission.check_rate('horns&hoofs', 2)
+
+    def test_duplicate_client_ids(self):
+        class CountingStore(object):
+            calls = 0
+
+            def get(self, key, deadline=None):
+                self.calls += 1
+                return []
+
+        api.MainHTTPHandler.store = CountingStore()
+        api.MainHTTPHandler.admission = AdmissionControl(rate=1, burst=5, max_client_ids=5, clock=self.clock)
+        try:
+            _, code = self.get_response(self.clients_interests_request([1] * 1000 + [2]))
+            self.assertEqual(api.OK, code)
+            # стоимость запроса равна кол-ву уникальных id и совпадает с кол-вом обращений к хранилищу
+            self.assertEqual(api.MainHTTPHandler.store.calls, 2)
+            self.assertEqual(api.MainHTTPHandler.admission.buckets['horns&hoofs'].tokens, 3)
+        finally:
+            api.MainHTTPHandler.store = None
+
+    def test_cost_exceeds_burst(self):
+        api.MainHTTPHandler.admission = AdmissionControl(rate=1, burst=2, clock=self.clock)
+        _, code = self.get_response(self.clients_interests_request([1, 2, 3]))
+        self.assertEqual(api.REQUEST_ENTITY_TOO_LARGE, code)
+        # запрос не расходует токены ведра
+        self.assertEqual(api.MainHTTPHandler.admission.buckets, {})
+
 
 def has_storage():
     result = False
@@ -145,6 +480,10 @@ class StorageTest(unittest.TestCase):
     def setUp(self):
         self.store = Store(connect_timeout=5, attempts=3)
 
+    def test_check_on_connected_store(self):
+        self.assertTrue(self.store.check())
+        self.assertEqual(self.store.state, 'connected')
+
     def test_on_disconnected_store_cache_set_cache_get(self):
         self.store = Store(port=9999, connect_timeout=1, attempts=1)
 
@@ -175,6 +514,90 @@ class StorageTest(unittest.TestCase):
         self.assertEqual(value, [kwargs['value']])
 
 
+class CompactStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = CompactStore(connect_timeout=5, attempts=3)
+
+    def test_cache_location(self):
+        bucket, field = self.store.cache_location('uid:c20ad4d76fe97759aa27a0c99bff6710', 5)
+        self.assertEqual(bucket, 'uid:5:c20a')
+        self.assertEqual(len(field), 14)
+
+    @cases(['uid:не hex', 'uid:123', 'uid:12', 'nokey'])
+    def test_cache_location_not_hex(self, key):
+        bucket, field = self.store.cache_location(key, 5)
+        self.assertEqual(len(bucket.rpartition(':')[2]), 4)
+        self.assertTrue(field)
+
+    @cases([1, 3])
+    def test_cache_location_bucket_bytes(self, bucket_bytes):
+        self.store = CompactStore(bucket_bytes=bucket_bytes)
+        bucket, field = self.store.cache_location('uid:c20ad4d76fe97759aa27a0c99bff6710', 5)
+        self.assertEqual(bucket, 'uid:5:' + 'c20ad4'[:2 * bucket_bytes])
+        self.assertEqual(len(field), 16 - bucket_bytes)
+
+    @cases([(1, 1), (-3.7, -3.7), (13.7, 13.7)])
+    def test_pack_unpack_value(self, args):
+        value, expected = args
+        data = CompactStore.pack_value(value, 60)
+        self.assertEqual(len(data), 12)
+        self.assertEqual(CompactStore.unpack_value(data), expected)
+
+    @cases(['', 'abc', '1.5', '\x00' * 13])
+    def test_unpack_malformed_value(self, data):
+        self.assertIsNone(CompactStore.unpack_value(data))
+
+    @unittest.skipUnless(flag_has_storage, 'Storage tests are skipping')
+    def test_on_connected_store_malformed_value_is_miss(self):
+        self.store.connect()
+        key = "uid:c20ad4d76fe97759aa27a0c99bff6710"
+        self.store.redis.hset(*(self.store.cache_location(key, self.store.current_window()) + ('3.5',)))
+        self.assertIsNone(self.store.cache_get(key))
+
+    def test_unpack_expired_value(self):
+        self.assertIsNone(CompactStore.unpack_value(CompactStore.pack_value(1.5, -1)))
+
+    def test_on_disconnected_store_cache_set_cache_get(self):
+        self.store = CompactStore(port=9999, connect_timeout=1, attempts=1)
+        key = "uid:c20ad4d76fe97759aa27a0c99bff6710"
+        self.store.cache_set(key, -1, 60)
+        self.assertEqual(self.store.cache_get(key) or 0, 0)
+
+    @unittest.skipUnless(flag_has_storage, 'Storage tests are skipping')
+    @cases([{'key': "uid:c20ad4d76fe97759aa27a0c99bff6710", 'value': 1},
+            {'key': "uid:c20ad4d76fe97759aa27a0c99bff6710", 'value': -3.7}])
+    def test_on_connected_store_cache_set_cache_get(self, kwargs):
+        self.store.connect()
+        self.store.cache_set(kwargs['key'], kwargs['value'], 60 * 60)
+        self.assertEqual(self.store.cache_get(kwargs['key']), kwargs['value'])
+        bucket, _ = self.store.cache_location(kwargs['key'], self.store.current_window())
+        self.assertTrue(0 < self.store.redis.ttl(bucket) <= 2 * 60 * 60)
+
+    @unittest.skipUnless(flag_has_storage, 'Storage tests are skipping')
+    def test_on_connected_store_unread_value_reclaimed(self):
+        self.store = CompactStore(connect_timeout=5, attempts=3, window=1)
+        key = "uid:c20ad4d76fe97759aa27a0c99bff6710"
+        bucket, _ = self.store.cache_location(key, self.store.current_window())
+        self.store.cache_set(key, 1.5, 60 * 60)
+        self.assertTrue(self.store.redis.exists(bucket))
+        # значение не читается, бакет удаляется redis по истечении следующего окна
+        time.sleep(2.5)
+        self.assertFalse(self.store.redis.exists(bucket))
+        self.assertIsNone(self.store.cache_get(key))
+
+    @unittest.skipUnless(flag_has_storage, 'Storage tests are skipping')
+    def test_on_connected_store_cache_get_from_previous_window(self):
+        self.store = CompactStore(connect_timeout=5, attempts=3, window=2)
+        key = "uid:c20ad4d76fe97759aa27a0c99bff6710"
+        # запись в конце окна, чтение - уже в следующем
+        time.sleep((1.5 - time.time() % 2) % 2)
+        window = self.store.current_window()
+        self.store.cache_set(key, 2.5, 60 * 60)
+        time.sleep(1)
+        self.assertEqual(self.store.current_window(), window + 1)
+        self.assertEqual(self.store.cache_get(key), 2.5)
+
+
 class ScoringTest(unittest.TestCase):
     def setUp(self):
         self.store = Store(connect_timeout=5, attempts=3)
@@ -210,6 +633,110 @@ class ScoringTest(unittest.TestCase):
         self.store.cache_set('uid:99e176a6339c3ed7d753d610e2580f01', -0.9, 60 * 60)
         self.assertAlmostEqual(scoring.get_score(self.store, **kwargs), score, delta=0.1)
 
+    class HistoryStore(object):
+        """Хранилище с историей интересов, считающее кол-во pipelined запросов"""
+        def __init__(self, history):
+            self.history = history
+            self.calls = 0
+
+        def get_as_of(self, keys, version, deadline=None):
+            self.calls += 1
+            result = []
+            for key in keys:
+                versions = sorted(v for v in self.history.get(key, {}) if v <= version)
+                result.append(self.history[key][versions[-1]] if versions else None)
+            return result
+
+    def test_get_interests_as_of(self):
+        store = self.HistoryStore({'ih:1': {20170101: ['books'], 20170801: ['tv']},
+                                   'ih:2': {20170720: ['travel']},
+                                   'ih:3': {20180101: ['geek']}})
+        date = api.DateField.str_to_date('20.07.2017')
+        result = {}
+        for batch in scoring.get_interests_as_of(store, [1, 2, 3, 4, 5], date, batch_size=2):
+            result.update(batch)
+        self.assertEqual(result, {1: ['books'], 2: ['travel'], 3: None, 4: None, 5: None})
+        self.assertEqual(store.calls, 3)
+
+    def test_clients_interests_with_date_without_history(self):
+        api.MainHTTPHandler.store = self.HistoryStore({'ih:2': {20180101: ['geek']}, 'ih:3': {20170101: []}})
+        ctx = {}
+        try:
+            result = api.MainHTTPHandler.clients_interests(api.MainHTTPHandler, client_ids=[1, 2, 3], ctx=ctx,
+                                                           date='20.07.2017')
+        finally:
+            api.MainHTTPHandler.store = None
+        # текущие интересы на прошедшую дату не возвращаются
+        self.assertEqual(result, {1: [], 2: [], 3: []})
+        self.assertEqual(ctx, {'no_history': [1, 2]})
+
+    @unittest.skipUnless(flag_has_storage, 'Skipping get_interests_as_of cases')
+    def test_on_connected_store_get_interests_as_of_without_history(self):
+        for cid, interests in ((5, ['books', 'tv']), (6, ['geek'])):
+            self.store.redis.delete('ih:{}'.format(cid), 'i:{}'.format(cid))
+            self.store.redis.rpush('i:{}'.format(cid), *interests)
+        scoring.set_interests_as_of(self.store, 6, api.DateField.str_to_date('01.01.2018'), ['travel'])
+        api.MainHTTPHandler.store = self.store
+        ctx = {}
+        try:
+            result = api.MainHTTPHandler.clients_interests(api.MainHTTPHandler, client_ids=[5, 6], ctx=ctx,
+                                                           date='20.07.2017')
+        finally:
+            api.MainHTTPHandler.store = None
+        self.assertEqual(result, {5: [], 6: []})
+        self.assertEqual(ctx, {'no_history': [5, 6]})
+
+    @unittest.skipUnless(flag_has_storage, 'Skipping get_interests_as_of cases')
+    def test_on_connected_store_set_interests(self):
+        self.store.redis.delete('i:8', 'ih:8')
+        scoring.set_interests(self.store, 8, ['books'], api.DateField.str_to_date('01.01.2017'))
+        scoring.set_interests(self.store, 8, ['tv', 'geek'], api.DateField.str_to_date('01.08.2017'))
+        self.assertEqual(scoring.get_interests(self.store, 8), ['tv', 'geek'])
+        date = api.DateField.str_to_date('20.07.2017')
+        self.assertEqual(list(scoring.get_interests_as_of(self.store, [8], date)), [{8: ['books']}])
+
+    @unittest.skipUnless(flag_has_storage, 'Skipping get_interests_as_of cases')
+    def test_on_connected_store_backfill_interests_history(self):
+        for cid, interests in ((9, ['books']), (10, ['tv'])):
+            self.store.redis.delete('ih:{}'.format(cid), 'i:{}'.format(cid))
+            self.store.redis.rpush('i:{}'.format(cid), *interests)
+        scoring.set_interests_as_of(self.store, 10, api.DateField.str_to_date('01.01.2017'), ['geek'])
+        date = api.DateField.str_to_date('01.08.2017')
+        self.assertGreaterEqual(scoring.backfill_interests_history(self.store, date), 1)
+        # история клиента 10 уже была и не изменяется
+        self.assertEqual(list(scoring.get_interests_as_of(self.store, [9, 10], date)),
+                         [{9: ['books'], 10: ['geek']}])
+        self.assertEqual(list(scoring.get_interests_as_of(self.store, [9], api.DateField.str_to_date('31.07.2017'))),
+                         [{9: None}])
+
+    def test_clients_interests_with_date_duplicate_ids(self):
+        store = self.HistoryStore({'ih:1': {20170101: ['books']}})
+        api.MainHTTPHandler.store = store
+        try:
+            result = api.MainHTTPHandler.clients_interests(api.MainHTTPHandler, client_ids=[1] * 1000,
+                                                           date='01.08.2017')
+        finally:
+            api.MainHTTPHandler.store = None
+        self.assertEqual(result, {1: ['books']})
+        self.assertEqual(store.calls, 1)
+
+    def test_clients_interests_with_date(self):
+        api.MainHTTPHandler.store = self.HistoryStore({'ih:1': {20170101: ['books'], 20170801: ['tv']}})
+        try:
+            result = api.MainHTTPHandler.clients_interests(api.MainHTTPHandler, client_ids=[1, 2],
+                                                           date='01.08.2017')
+        finally:
+            api.MainHTTPHandler.store = None
+        self.assertEqual(result, {1: ['tv'], 2: []})
+
+    @unittest.skipUnless(flag_has_storage, 'Skipping get_interests_as_of cases')
+    def test_on_connected_store_set_get_interests_as_of(self):
+        self.store.redis.delete('ih:1', 'ih:2')
+        for date, interests in (('01.01.2017', ['books']), ('01.08.2017', ['books']), ('01.09.2017', ['tv'])):
+            scoring.set_interests_as_of(self.store, 1, api.DateField.str_to_date(date), interests)
+        date = api.DateField.str_to_date('20.08.2017')
+        self.assertEqual(list(scoring.get_interests_as_of(self.store, [1, 2], date)), [{1: ['books'], 2: None}])
+
     @unittest.expectedFailure
     def test_on_disconnected_store_get_interests(self):
         self.store = Store(port=9999, connect_timeout=1, attempts=2)